@@ -5,6 +5,16 @@ import argparse
 import cv2
 import numpy as np
 import pickle
+import gc
+import time
+import threading
+import queue
+import select
+import signal
+import struct
+import re
+import subprocess
+from collections import OrderedDict, deque
 from datetime import datetime
 
 # Lazy import to speed up initial checks
@@ -63,15 +73,467 @@ else:
 def setup_logger():
     pass
 
+SWAP_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+# Hot-folder watch mode defaults
+DEFAULT_WATCH_CONCURRENCY = 1
+DEFAULT_WATCH_QUEUE_SIZE = 32
+DEFAULT_WATCH_POLL_INTERVAL = 2.0
+DEFAULT_WATCH_RESCAN_INTERVAL = 30.0
+
+# Default number of images/frames handled per chunk (one ArcFace call for all their faces)
+DEFAULT_BATCH_SIZE = 8
+# Detection threshold for the batched path (FaceAnalysis.prepare's default, which the adaptive path ends up using too)
+DEFAULT_DET_THRESH = 0.5
+# Upper bound on how long a video/stream batch may wait to fill up before it is flushed
+DEFAULT_MAX_BATCH_LATENCY_MS = 200
+
+def chunked(items, size):
+    size = max(1, int(size))
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+# Soft cap on the estimated memory of all resident models. Time-based unloading is opt-in
+# (0 = off) so long-running modes keep their models warm between jobs.
+DEFAULT_MODEL_MEMORY_MB = 3072
+DEFAULT_MODEL_IDLE_SECONDS = 0
+
+def estimate_model_bytes(obj, skip=('bg_upsampler',), max_depth=3):
+    # Walks a loaded model wrapper: torch modules count their parameters + buffers,
+    # insightface ONNX models count their weights file (onnxruntime keeps roughly that much resident).
+    # Shared sub-models (the RealESRGAN background upsampler) are tracked as their own entry and skipped here.
+    seen = set()
+    total = 0
+
+    def visit(o, depth):
+        nonlocal total
+        if o is None or depth > max_depth or id(o) in seen:
+            return
+        seen.add(id(o))
+
+        if callable(getattr(o, 'parameters', None)) and callable(getattr(o, 'buffers', None)):
+            for t in list(o.parameters()) + list(o.buffers()):
+                total += t.numel() * t.element_size()
+            return
+
+        model_file = getattr(o, 'model_file', None)
+        if isinstance(model_file, str) and os.path.exists(model_file):
+            total += os.path.getsize(model_file)
+            return
+
+        if isinstance(o, dict):
+            values = list(o.values())
+        elif isinstance(o, (list, tuple)):
+            values = list(o)
+        elif hasattr(o, '__dict__'):
+            values = [v for k, v in vars(o).items() if k not in skip]
+        else:
+            return
+        for v in values:
+            visit(v, depth + 1)
+
+    visit(obj, 0)
+    return total
+
+class ModelResidencyManager:
+    """
+    Loads models on demand by name and keeps them resident in LRU order.
+    When the estimated footprint goes over budget, least recently used models are unloaded.
+    If idle_seconds is set, models unused for that long are also unloaded by a background sweeper thread.
+    """
+    def __init__(self, budget_mb=DEFAULT_MODEL_MEMORY_MB, idle_seconds=DEFAULT_MODEL_IDLE_SECONDS, grace_seconds=5):
+        self.budget_bytes = int(budget_mb * 1024 * 1024) if budget_mb else None
+        self.idle_seconds = idle_seconds
+        # Models touched this recently are in use by the current frame/job and are never evicted for space
+        self.grace_seconds = grace_seconds
+        self._entries = OrderedDict()
+        # Footprints of models seen before, so room can be made before reloading them
+        self._known_bytes = {}
+        self._lock = threading.RLock()
+        self._sweeper = None
+
+    def _start_idle_sweeper(self):
+        # Only with an explicit idle_seconds: steady-state access goes through get(), so the
+        # opt-in idle unload has to run on a timer rather than only when something new is loaded
+        if not self.idle_seconds or self._sweeper is not None:
+            return
+        interval = max(1.0, min(self.idle_seconds / 4.0, 30.0))
+
+        def sweep():
+            while True:
+                time.sleep(interval)
+                self.unload_idle()
+
+        self._sweeper = threading.Thread(target=sweep, daemon=True)
+        self._sweeper.start()
+
+    def get(self, name):
+        # Returns the resident model (None if unloaded) and counts as a use for LRU/idle tracking
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            self._touch(name)
+            return entry['model']
+
+    def _touch(self, name):
+        # Dependencies are touched after the model so they never become LRU before the models using them
+        for dep in (name,) + self._entries[name]['requires']:
+            if dep in self._entries:
+                self._entries[dep]['last_used'] = time.time()
+                self._entries.move_to_end(dep)
+
+    def acquire(self, name, loader, requires=()):
+        with self._lock:
+            self.unload_idle()
+            entry = self._entries.get(name)
+            if entry is None:
+                if name in self._known_bytes:
+                    self._make_room(self._known_bytes[name], keep=(name,) + tuple(requires))
+
+                model = loader()
+                if model is None:
+                    return None
+
+                size = estimate_model_bytes(model)
+                self._known_bytes[name] = size
+                entry = {
+                    'model': model,
+                    'bytes': size,
+                    'loaded_at': time.time(),
+                    'last_used': time.time(),
+                    'requires': tuple(requires)
+                }
+                self._entries[name] = entry
+                self._start_idle_sweeper()
+                print(f"Model resident: {name} (~{size / (1024 * 1024):.0f} MB)", file=sys.stderr)
+                self._make_room(0, keep=(name,) + tuple(requires))
+
+            self._touch(name)
+            return entry['model']
+
+    def unload(self, name):
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is None:
+                return
+            # Dependents hold a reference to this model, so its memory is only freed if they go too
+            for other in [k for k, e in self._entries.items() if name in e['requires']]:
+                self.unload(other)
+            print(f"Model unloaded: {name} (~{entry['bytes'] / (1024 * 1024):.0f} MB)", file=sys.stderr)
+            del entry
+            gc.collect()
+
+    def unload_idle(self):
+        if not self.idle_seconds:
+            return
+        with self._lock:
+            now = time.time()
+            for name in [k for k, e in self._entries.items() if now - e['last_used'] > self.idle_seconds]:
+                self.unload(name)
+
+    def total_bytes(self):
+        return sum(e['bytes'] for e in self._entries.values())
+
+    def _make_room(self, incoming_bytes, keep=()):
+        if self.budget_bytes is None:
+            return
+        while self.total_bytes() + incoming_bytes > self.budget_bytes:
+            now = time.time()
+            candidates = [k for k, e in self._entries.items() if k not in keep and now - e['last_used'] >= self.grace_seconds]
+            if not candidates:
+                print(f"Warning: resident models (~{self.total_bytes() / (1024 * 1024):.0f} MB) exceed budget of {self.budget_bytes / (1024 * 1024):.0f} MB", file=sys.stderr)
+                return
+            # OrderedDict keeps least recently used first
+            self.unload(candidates[0])
+
+    def resident(self):
+        now = time.time()
+        with self._lock:
+            return [{
+                "name": name,
+                "memory_mb": round(e['bytes'] / (1024 * 1024), 1),
+                "idle_seconds": int(now - e['last_used']),
+                "requires": list(e['requires'])
+            } for name, e in self._entries.items()]
+
+    def report(self):
+        return {
+            "models": self.resident(),
+            "total_mb": round(self.total_bytes() / (1024 * 1024), 1),
+            "budget_mb": round(self.budget_bytes / (1024 * 1024), 1) if self.budget_bytes else None
+        }
+
+class InotifyWatcher:
+    """
+    Minimal Linux inotify wrapper (via libc, no extra dependency) reporting files in one
+    directory that were closed after writing or moved in. Raises OSError where unavailable.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_Q_OVERFLOW = 0x00004000
+
+    def __init__(self, path):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux")
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        # IN_NONBLOCK / IN_CLOEXEC share their values with O_NONBLOCK / O_CLOEXEC
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+        if wd < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, f"inotify_add_watch failed for {path}")
+
+    def read(self, timeout):
+        # Returns (names, overflowed); on overflow the kernel dropped events and the caller should rescan
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return [], False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return [], False
+
+        # struct inotify_event { int wd; uint32 mask; uint32 cookie; uint32 len; char name[len]; }
+        names = []
+        overflowed = False
+        offset = 0
+        while offset + 16 <= len(data):
+            _, mask, _, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset + 16:offset + 16 + length].rstrip(b'\0')
+            offset += 16 + length
+            if mask & self.IN_Q_OVERFLOW:
+                overflowed = True
+            elif name:
+                names.append(os.fsdecode(name))
+        return names, overflowed
+
+    def close(self):
+        os.close(self.fd)
+
+class ProcessedLedger:
+    """
+    Append-only JSON-lines record of files the watcher already handled, keyed by
+    name + size + mtime so a replaced file is picked up again after a restart.
+    Only successes count as done; failures are skipped for the rest of this run but retried on restart.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._keys = set()
+        self._failed = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        if entry.get('status') == 'ok':
+                            self._keys.add((entry['file'], entry['size'], entry['mtime']))
+                    except (ValueError, KeyError, AttributeError):
+                        continue
+
+    def __contains__(self, key):
+        return key in self._keys or key in self._failed
+
+    def record(self, key, status, output_path=None):
+        filename, size, mtime = key
+        entry = {
+            "file": filename,
+            "size": size,
+            "mtime": mtime,
+            "status": status,
+            "output_path": output_path,
+            "processed_at": datetime.now().isoformat()
+        }
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+            if status == 'ok':
+                self._keys.add(key)
+            else:
+                self._failed.add(key)
+
+# Adaptive quality ladder for stream_swap, cheapest last. The controller steps down when
+# recent latency exceeds the budget and back up when there is plenty of headroom.
+STREAM_QUALITY_LEVELS = [
+    {"name": "full", "det_size": (640, 640), "enhance": True},
+    {"name": "no_enhance", "det_size": (640, 640), "enhance": False},
+    {"name": "fast_detect", "det_size": (320, 320), "enhance": False},
+]
+DEFAULT_STREAM_FORMAT = 'mpegts'
+DEFAULT_STREAM_REPORT_INTERVAL = 2.0
+
+def get_ffmpeg_exe():
+    # moviepy ships ffmpeg through imageio-ffmpeg; fall back to whatever is on PATH
+    try:
+        import imageio_ffmpeg
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except Exception:
+        return 'ffmpeg'
+
+def is_stdio_target(path):
+    return path in ('-', 'pipe:', 'pipe:0', 'pipe:1')
+
+class FFmpegFrameReader:
+    """
+    Decodes any ffmpeg-readable source (file, URL, named FIFO, or '-' for our stdin) to BGR
+    frames on a background thread. Frames are timestamped on arrival and kept in a bounded
+    deque so the consumer can take the newest one and treat the rest as dropped; frames that
+    fall off the deque show up as gaps in the sequence numbers.
+    """
+    def __init__(self, source, header_timeout=30.0, max_buffered=30):
+        use_stdin = is_stdio_target(source)
+        # -nostats keeps the carriage-return progress line off stderr, info level still prints the stream info
+        cmd = [get_ffmpeg_exe(), '-hide_banner', '-nostats', '-loglevel', 'info']
+        if not use_stdin:
+            cmd.append('-nostdin')
+        if not use_stdin and os.path.isfile(source):
+            # Regular files would otherwise decode as fast as possible; live sources pace themselves
+            cmd.append('-re')
+        cmd += ['-i', 'pipe:0' if use_stdin else source,
+                '-an', '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+        self.process = subprocess.Popen(cmd, stdin=None if use_stdin else subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.width = None
+        self.height = None
+        self.fps = None
+        self.frames = deque(maxlen=max_buffered)
+        self.finished = False
+        self.received = 0
+        self._cond = threading.Condition()
+        self._header = threading.Event()
+        self._stream_re = re.compile(r'Stream #.*Video:.*?, (\d{2,5})x(\d{2,5})')
+        self._fps_re = re.compile(r'(\d+(?:\.\d+)?) (?:fps|tbr)')
+
+        threading.Thread(target=self._read_stderr, daemon=True).start()
+        if not self._header.wait(header_timeout) or not self.width:
+            self.close()
+            raise RuntimeError(f"Could not read video stream info from {source}")
+        threading.Thread(target=self._read_frames, daemon=True).start()
+
+    def _read_stderr(self):
+        # ffmpeg prints the stream descriptions before any frame is decoded. The size is taken from
+        # the Output #0 rawvideo stream, not the input one: autorotation (phone clips with a 90 degree
+        # rotation tag) swaps width and height between the two.
+        in_output = False
+        for raw in iter(self.process.stderr.readline, b''):
+            line = raw.decode('utf-8', errors='replace').strip()
+            if line.startswith('Output #'):
+                in_output = True
+            if in_output and not self._header.is_set():
+                match = self._stream_re.search(line)
+                if match:
+                    self.width, self.height = int(match.group(1)), int(match.group(2))
+                    fps = self._fps_re.search(line)
+                    self.fps = float(fps.group(1)) if fps else 25.0
+                    self._header.set()
+            if 'error' in line.lower():
+                print(f"ffmpeg (input): {line}", file=sys.stderr)
+        self._header.set()
+
+    def _read_frames(self):
+        frame_bytes = self.width * self.height * 3
+        while True:
+            data = self.process.stdout.read(frame_bytes)
+            if not data or len(data) < frame_bytes:
+                break
+            frame = np.frombuffer(data, dtype=np.uint8).reshape((self.height, self.width, 3))
+            with self._cond:
+                self.frames.append((self.received, time.time(), frame))
+                self.received += 1
+                self._cond.notify()
+        with self._cond:
+            self.finished = True
+            self._cond.notify()
+
+    def take_all(self, timeout=1.0):
+        # Returns every frame that arrived since the last call, oldest first: [] if none arrived
+        # within the timeout, None once the source is exhausted
+        with self._cond:
+            if not self.frames and not self.finished:
+                self._cond.wait(timeout)
+            if not self.frames and self.finished:
+                return None
+            frames = list(self.frames)
+            self.frames.clear()
+            return frames
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+# Dataset pre-filter thresholds: shortest side in pixels, Laplacian variance of the
+# grayscale thumbnail, and max Hamming distance between perceptual hashes of near-duplicates
+DEFAULT_MIN_IMAGE_SIZE = 128
+DEFAULT_BLUR_THRESHOLD = 15.0
+DEFAULT_DEDUP_DISTANCE = 6
+PREFILTER_CACHE_NAME = '.prefilter_cache.json'
+
+def image_quality_signals(filepath):
+    # Cheap signals only: JPEG decodes straight to a 1/4 scale grayscale thumbnail, no ONNX involved
+    thumb = cv2.imread(filepath, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+    if thumb is None:
+        return None
+
+    try:
+        from PIL import Image
+        with Image.open(filepath) as pil_img:
+            width, height = pil_img.size
+    except Exception:
+        height, width = thumb.shape[0] * 4, thumb.shape[1] * 4
+
+    # Blur is measured at a fixed scale so the score doesn't depend on the source resolution
+    scale = 256.0 / max(thumb.shape[:2])
+    sample = cv2.resize(thumb, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else thumb
+    blur = float(cv2.Laplacian(sample, cv2.CV_64F).var())
+
+    # pHash: low-frequency 8x8 block of the DCT of a 32x32 thumbnail, thresholded at its median
+    small = cv2.resize(thumb, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(small)[:8, :8].flatten()
+    bits = low_freq > np.median(low_freq[1:])
+    phash = 0
+    for bit in bits:
+        phash = (phash << 1) | int(bit)
+
+    return {"width": int(width), "height": int(height), "blur": round(blur, 2), "phash": f"{phash:016x}"}
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
 class FaceTrainer:
-    def __init__(self):
-        self.app = None
-        self.swapper = None
-        self.enhancer = None
+    def __init__(self, model_memory_mb=DEFAULT_MODEL_MEMORY_MB, model_idle_seconds=DEFAULT_MODEL_IDLE_SECONDS):
+        self.models = ModelResidencyManager(budget_mb=model_memory_mb, idle_seconds=model_idle_seconds)
+        self.current_upscale = 1
         self.current_source_embedding = None
-        
+        # Adaptive detection re-prepares the shared detector and GFPGAN's face helper keeps
+        # per-call state, so both are serialized when frames are processed from several threads
+        self._detect_lock = threading.Lock()
+        self._enhance_lock = threading.Lock()
+
+    # Models live in the residency manager; these return what is resident right now (None if unloaded)
+    @property
+    def app(self):
+        return self.models.get('buffalo_l')
+
+    @property
+    def swapper(self):
+        return self.models.get('inswapper_128')
+
+    @property
+    def enhancer(self):
+        return self.models.get(f'gfpgan_x{self.current_upscale}')
+
     def initialize(self):
         get_imports()
+        return self.models.acquire('buffalo_l', self._load_face_analysis)
+
+    def _load_face_analysis(self):
         # Initialize detection model
         # providers = ['CUDAExecutionProvider', 'CoreMLExecutionProvider', 'CPUExecutionProvider']
         
@@ -82,18 +544,18 @@ class FaceTrainer:
         # Actually, let's try to remove provider restriction and let it default (likely CoreML first) 
         # but keep the Monkey Patch for NMS/NoneType safety in try-catch blocks we added.
         # If it crashes again, we know CoreML is the culprit. But since it fails to DETECT, maybe CPU is the problem.
-        self.app = FaceAnalysis(name='buffalo_l', allowed_modules=['detection', 'recognition']) 
+        app = FaceAnalysis(name='buffalo_l', allowed_modules=['detection', 'recognition']) 
         # Increase det_size to better detect faces in high-res images. (640, 640) is default but sometimes too small.
         # (1280, 1280) usually gives better results for portraits.
-        self.app.prepare(ctx_id=0, det_size=(640, 640)) # Reset to default, let adaptive handle sizes
+        app.prepare(ctx_id=0, det_size=(640, 640)) # Reset to default, let adaptive handle sizes
         
         # Monkey patch the internal models of FaceAnalysis if they suffer from the same issue
-        if hasattr(self.app, 'models'):
+        if hasattr(app, 'models'):
             # Check if models is a dict (newer versions) or list
-            models_iter = self.app.models.keys() if isinstance(self.app.models, dict) else range(len(self.app.models))
+            models_iter = app.models.keys() if isinstance(app.models, dict) else range(len(app.models))
             
             for key in models_iter:
-                model = self.app.models[key]
+                model = app.models[key]
                 # Force set taskname if missing, don't just check
                 if not hasattr(model, 'taskname'):
                     name_hint = str(key) if isinstance(key, str) else ''
@@ -102,6 +564,74 @@ class FaceTrainer:
                 # Ensure prepare method exists
                 if not hasattr(model, 'prepare'):
                     model.prepare = lambda ctx_id, **kwargs: None
+        return app
+
+    def get_recognition_model(self):
+        if isinstance(self.app.models, dict):
+            return self.app.models.get('recognition')
+        for model in self.app.models:
+            if getattr(model, 'taskname', None) == 'recognition':
+                return model
+        return None
+
+    def detect_batch(self, imgs, det_size=(640, 640), det_thresh=DEFAULT_DET_THRESH):
+        """
+        Detect faces in a list of BGR images at one common det_size (no re-prepare between images).
+        Returns one (det, kpss) pair per image, in the same order.
+        """
+        det_model = self.app.det_model
+
+        # buffalo_l's det_10g has no dynamic batch axis, so detection stays one public detect() call
+        # per image; the batching win is in embed_batch. detect() reads det_thresh from the model,
+        # so it is set under the same lock the adaptive path holds while it changes it.
+        results = []
+        for img in imgs:
+            with self._detect_lock:
+                det_model.det_thresh = det_thresh
+                results.append(det_model.detect(img, input_size=det_size))
+        return results
+
+    def embed_batch(self, imgs, faces_per_image):
+        # Align every face crop across the whole batch and run ArcFace once, then map back
+        from insightface.utils import face_align
+        rec_model = self.get_recognition_model()
+        if rec_model is None:
+            return
+
+        crops, owners = [], []
+        for img, faces in zip(imgs, faces_per_image):
+            for face in faces:
+                crops.append(face_align.norm_crop(img, landmark=face.kps, image_size=rec_model.input_size[0]))
+                owners.append(face)
+        if not crops:
+            return
+
+        batch_dim = rec_model.session.get_inputs()[0].shape[0]
+        rec_batch = batch_dim if isinstance(batch_dim, int) else len(crops)
+        feats = np.vstack([rec_model.get_feat(chunk) for chunk in chunked(crops, rec_batch)])
+        for face, feat in zip(owners, feats):
+            face.embedding = feat.flatten()
+
+    def get_faces_batch(self, imgs, det_size=(640, 640), with_embedding=True):
+        """
+        Batched equivalent of self.app.get for a list of images.
+        Swapping only needs kps, so callers can skip recognition with with_embedding=False.
+        """
+        from insightface.app.common import Face
+        if not self.app:
+            self.initialize()
+
+        faces_per_image = []
+        for det, kpss in self.detect_batch(imgs, det_size):
+            faces = []
+            for i in range(det.shape[0]):
+                kps = kpss[i] if kpss is not None else None
+                faces.append(Face(bbox=det[i, 0:4], kps=kps, det_score=det[i, 4]))
+            faces_per_image.append(faces)
+
+        if with_embedding:
+            self.embed_batch(imgs, faces_per_image)
+        return faces_per_image
 
     def detect_faces(self, dataset_path):
         if not self.app:
@@ -133,69 +663,171 @@ class FaceTrainer:
                 
         return {"results": results, "total_images": len(files)}
 
-    def train_model(self, dataset_path, output_path, model_name):
-        if not self.app:
-            self.initialize()
-            
+    def prefilter_dataset(self, dataset_path, files, min_size=DEFAULT_MIN_IMAGE_SIZE,
+                          blur_threshold=DEFAULT_BLUR_THRESHOLD, dedup_distance=DEFAULT_DEDUP_DISTANCE):
+        """
+        Drop unreadable, tiny, blurry and near-duplicate images before any detection/recognition runs.
+        Signals are cached per file (by size + mtime) in the dataset folder; thresholds are applied fresh each time.
+        Returns (kept_files, report) with kept_files in the original order.
+        """
+        cache_path = os.path.join(dataset_path, PREFILTER_CACHE_NAME)
+        cache = {}
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'r', encoding='utf-8') as f:
+                    cache = json.load(f)
+            except (OSError, ValueError):
+                cache = {}
+
+        skipped = {"unreadable": [], "too_small": [], "blurry": [], "duplicate": []}
+        candidates = []
+        new_cache = {}
+        cache_hits = 0
+
+        for filename in files:
+            filepath = os.path.join(dataset_path, filename)
+            try:
+                st = os.stat(filepath)
+            except OSError:
+                skipped["unreadable"].append(filename)
+                continue
+
+            cached = cache.get(filename)
+            if cached and cached.get("size") == st.st_size and cached.get("mtime") == int(st.st_mtime):
+                signals = cached.get("signals")
+                cache_hits += 1
+            else:
+                try:
+                    signals = image_quality_signals(filepath)
+                except Exception as e:
+                    print(f"Warning: pre-filter failed for {filename}: {e}", file=sys.stderr)
+                    signals = None
+            new_cache[filename] = {"size": st.st_size, "mtime": int(st.st_mtime), "signals": signals}
+
+            if signals is None:
+                skipped["unreadable"].append(filename)
+            elif min(signals["width"], signals["height"]) < min_size:
+                skipped["too_small"].append(filename)
+            elif signals["blur"] < blur_threshold:
+                skipped["blurry"].append(filename)
+            else:
+                candidates.append((filename, signals))
+
+        # Near-duplicates: visit sharpest/largest first so each burst keeps its best shot
+        candidates.sort(key=lambda c: (c[1]["blur"], c[1]["width"] * c[1]["height"]), reverse=True)
+        kept = []
+        for filename, signals in candidates:
+            if any(hamming_distance(signals["phash"], other["phash"]) <= dedup_distance for _, other in kept):
+                skipped["duplicate"].append(filename)
+            else:
+                kept.append((filename, signals))
+
+        try:
+            with open(cache_path, 'w', encoding='utf-8') as f:
+                json.dump(new_cache, f)
+        except OSError as e:
+            print(f"Warning: could not write pre-filter cache: {e}", file=sys.stderr)
+
+        kept_names = {filename for filename, _ in kept}
+        report = {
+            "total": len(files),
+            "kept": len(kept_names),
+            "skipped": {reason: len(names) for reason, names in skipped.items()},
+            "skipped_files": {reason: names for reason, names in skipped.items() if names},
+            "cache_hits": cache_hits
+        }
+        return [f for f in files if f in kept_names], report
+
+    def train_model(self, dataset_path, output_path, model_name, batch_size=DEFAULT_BATCH_SIZE, prefilter=True,
+                    min_size=DEFAULT_MIN_IMAGE_SIZE, blur_threshold=DEFAULT_BLUR_THRESHOLD, dedup_distance=DEFAULT_DEDUP_DISTANCE):
         embeddings = []
         preview_image = None
         
         valid_extensions = ('.jpg', '.jpeg', '.png')
         files = [f for f in os.listdir(dataset_path) if f.lower().endswith(valid_extensions)]
+
+        prefilter_report = None
+        if prefilter:
+            files, prefilter_report = self.prefilter_dataset(dataset_path, files, min_size=min_size,
+                                                             blur_threshold=blur_threshold, dedup_distance=dedup_distance)
+            print(f"Pre-filter kept {prefilter_report['kept']}/{prefilter_report['total']} images, skipped: {json.dumps(prefilter_report['skipped'])}", file=sys.stderr)
+            if not files:
+                return {"success": False, "error": "No usable images left after pre-filtering", "prefilter": prefilter_report}
+
+        if not self.app:
+            self.initialize()
         
         total = len(files)
         processed = 0
         
-        for filename in files:
-            filepath = os.path.join(dataset_path, filename)
-            img = cv2.imread(filepath)
-            if img is None:
+        for batch_files in chunked(files, batch_size):
+            batch = []
+            for filename in batch_files:
+                img = cv2.imread(os.path.join(dataset_path, filename))
+                if img is not None:
+                    batch.append((filename, img))
+            if not batch:
                 continue
-                
+            imgs = [img for _, img in batch]
+
             try:
-                # Explicitly disable nms if possible or catch inside
-                # On macOS sometimes CoreML/CPU provider clash causes issues with NMS
-                # Let's try to run get() but if it fails deep in nms, we skip
-                faces = self.app.get(img)
+                # Detect the whole batch at once; only the largest face per image gets embedded below
+                faces_per_image = self.get_faces_batch(imgs, with_embedding=False)
             except Exception as e:
-                 # Catch ALL exceptions including TypeError for NoneType arithmetic in nms
-                 # This usually means model inference returned None for boxes/scores
-                 print(f"Warning: FaceAnalysis.get failed for {filename}: {e}", file=sys.stderr)
-                 faces = [] 
+                print(f"Warning: batched detection failed, falling back to per-image: {e}", file=sys.stderr)
+                faces_per_image = []
+                for filename, img in batch:
+                    try:
+                        # Explicitly disable nms if possible or catch inside
+                        # On macOS sometimes CoreML/CPU provider clash causes issues with NMS
+                        # Let's try to run get() but if it fails deep in nms, we skip
+                        faces_per_image.append(self.app.get(img))
+                    except Exception as e:
+                        # Catch ALL exceptions including TypeError for NoneType arithmetic in nms
+                        # This usually means model inference returned None for boxes/scores
+                        print(f"Warning: FaceAnalysis.get failed for {filename}: {e}", file=sys.stderr)
+                        faces_per_image.append([])
 
             # Smart filtering: assume the largest face is the user
-            if faces and len(faces) > 0:
-                faces = sorted(faces, key=lambda x: x.bbox[2] * x.bbox[3], reverse=True)
-                target_face = faces[0]
-                
-                # Check if embedding exists (if we only loaded detection, it might be missing)
-                if target_face.embedding is None:
-                    # If embedding is missing, we need recognition model
-                    # But we disabled it to fix detection crash.
-                    # We can try to run recognition separately or re-enable it carefully.
-                    # Actually, let's try to enable 'genderage' back but ensure providers is strictly CPU
-                    pass 
-                
-                # Store embedding
-                if target_face.embedding is not None:
-                    embeddings.append(target_face.embedding)
-                
-                # Save first good face as preview
-                if preview_image is None:
-                    bbox = target_face.bbox.astype(int)
-                    # Add some padding
-                    h, w, _ = img.shape
-                    p = 50
-                    x1 = max(0, bbox[0] - p)
-                    y1 = max(0, bbox[1] - p)
-                    x2 = min(w, bbox[2] + p)
-                    y2 = min(h, bbox[3] + p)
-                    preview_image = img[y1:y2, x1:x2]
-
-            processed += 1
+            target_faces = []
+            for faces in faces_per_image:
+                if faces and len(faces) > 0:
+                    faces = sorted(faces, key=lambda x: x.bbox[2] * x.bbox[3], reverse=True)
+                    target_faces.append([faces[0]])
+                else:
+                    target_faces.append([])
+
+            # One recognizer call for every selected face in the batch
+            if any(f and f[0].embedding is None for f in target_faces):
+                try:
+                    self.embed_batch(imgs, target_faces)
+                except Exception as e:
+                    print(f"Warning: batched recognition failed: {e}", file=sys.stderr)
+
+            for img, faces in zip(imgs, target_faces):
+                if faces:
+                    target_face = faces[0]
+
+                    # Store embedding
+                    if target_face.embedding is not None:
+                        embeddings.append(target_face.embedding)
+                    
+                    # Save first good face as preview
+                    if preview_image is None:
+                        bbox = target_face.bbox.astype(int)
+                        # Add some padding
+                        h, w, _ = img.shape
+                        p = 50
+                        x1 = max(0, bbox[0] - p)
+                        y1 = max(0, bbox[1] - p)
+                        x2 = min(w, bbox[2] + p)
+                        y2 = min(h, bbox[3] + p)
+                        preview_image = img[y1:y2, x1:x2]
+
+                processed += 1
 
         if not embeddings:
-            return {"success": False, "error": "No faces found in dataset"}
+            return {"success": False, "error": "No faces found in dataset", "prefilter": prefilter_report}
 
         # Calculate mean embedding
         mean_embedding = np.mean(embeddings, axis=0)
@@ -224,49 +856,57 @@ class FaceTrainer:
             "success": True, 
             "model_path": output_path,
             "preview_path": preview_path,
-            "faces_used": len(embeddings)
+            "faces_used": len(embeddings),
+            "prefilter": prefilter_report
         }
 
     def initialize_enhancer(self, upscale=1):
-        # Re-initialize if params changed or not initialized
-        if self.enhancer is not None and getattr(self, 'current_upscale', 1) == upscale:
-            return
+        # One GFPGANer per upscale value stays resident (budget permitting) instead of rebuilding on change
+        self.current_upscale = upscale
+        realesrgan_model_path = os.path.join(CHECKPOINTS_DIR, 'RealESRGAN_x2plus.pth')
+        requires = ('realesrgan_x2',) if upscale > 1 and os.path.exists(realesrgan_model_path) else ()
+        return self.models.acquire(f'gfpgan_x{upscale}', lambda: self._load_enhancer(upscale), requires=requires)
 
+    def _load_enhancer(self, upscale):
         get_enhancer_imports()
         
         model_path = os.path.join(CHECKPOINTS_DIR, 'GFPGANv1.4.pth')
         if not os.path.exists(model_path):
              print(f"Warning: GFPGAN model not found at {model_path}. Enhancement will be skipped.", file=sys.stderr)
-             self.enhancer = None
-             return
+             return None
 
-        # Check for RealESRGAN
-        realesrgan_model_path = os.path.join(CHECKPOINTS_DIR, 'RealESRGAN_x2plus.pth')
         bg_upsampler = None
-        
         if upscale > 1:
-            try:
-                if os.path.exists(realesrgan_model_path):
-                    from realesrgan import RealESRGANer
-                    from basicsr.archs.rrdbnet_arch import RRDBNet
-                    # RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
-                    model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
-                    bg_upsampler = RealESRGANer(
-                        scale=2,
-                        model_path=realesrgan_model_path,
-                        model=model,
-                        tile=400,
-                        tile_pad=10,
-                        pre_pad=0,
-                        half=False 
-                    )
-                    print(f"Background upsampler initialized: {realesrgan_model_path}", file=sys.stderr)
-            except Exception as e:
-                print(f"Warning: Failed to init RealESRGAN: {e}", file=sys.stderr)
+            # The x2 background upsampler is identical for every upscale, so all enhancers share one
+            bg_upsampler = self.models.acquire('realesrgan_x2', self._load_bg_upsampler)
 
         final_upscale = upscale 
-        self.enhancer = GFPGANer(model_path=model_path, upscale=final_upscale, arch='clean', channel_multiplier=2, bg_upsampler=bg_upsampler)
-        self.current_upscale = upscale
+        return GFPGANer(model_path=model_path, upscale=final_upscale, arch='clean', channel_multiplier=2, bg_upsampler=bg_upsampler)
+
+    def _load_bg_upsampler(self):
+        # Check for RealESRGAN
+        realesrgan_model_path = os.path.join(CHECKPOINTS_DIR, 'RealESRGAN_x2plus.pth')
+        bg_upsampler = None
+        
+        try:
+            if os.path.exists(realesrgan_model_path):
+                from realesrgan import RealESRGANer
+                from basicsr.archs.rrdbnet_arch import RRDBNet
+                # RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
+                model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
+                bg_upsampler = RealESRGANer(
+                    scale=2,
+                    model_path=realesrgan_model_path,
+                    model=model,
+                    tile=400,
+                    tile_pad=10,
+                    pre_pad=0,
+                    half=False 
+                )
+                print(f"Background upsampler initialized: {realesrgan_model_path}", file=sys.stderr)
+        except Exception as e:
+            print(f"Warning: Failed to init RealESRGAN: {e}", file=sys.stderr)
+        return bg_upsampler
 
     def load_model(self, model_path):
         if not os.path.exists(model_path):
@@ -286,45 +926,49 @@ class FaceTrainer:
     def ensure_swapper(self):
         # Ensure imports are available
         get_imports()
-        
-        if self.swapper is None:
-            model_file = os.path.join(CHECKPOINTS_DIR, 'inswapper_128.onnx')
-            if not os.path.exists(model_file):
-                raise FileNotFoundError("Inswapper model not found. Restart app to download.")
-            
-            self.swapper = insightface.model_zoo.get_model(model_file, providers=['CoreMLExecutionProvider', 'CPUExecutionProvider'])
-            
-            if not hasattr(self.swapper, 'taskname'):
-                self.swapper.taskname = 'swap'
+        return self.models.acquire('inswapper_128', self._load_swapper)
 
-    def process_frame(self, img, enhance=False, upscale=1):
-        """
-        Process a single image frame (numpy array) and return the result.
-        Assumes models are loaded.
-        """
-        # Ensure imports are available for process_frame if called directly or via ensure_swapper
-        if not self.app:
-            self.initialize()
+    def _load_swapper(self):
+        model_file = os.path.join(CHECKPOINTS_DIR, 'inswapper_128.onnx')
+        if not os.path.exists(model_file):
+            raise FileNotFoundError("Inswapper model not found. Restart app to download.")
+        
+        swapper = insightface.model_zoo.get_model(model_file, providers=['CoreMLExecutionProvider', 'CPUExecutionProvider'])
+        
+        if not hasattr(swapper, 'taskname'):
+            swapper.taskname = 'swap'
+        return swapper
 
+    def detect_target_faces(self, img, det_sizes=((640, 640), (320, 320), (1280, 1280))):
         # Adaptive Detection Strategy
-        det_sizes = [(640, 640), (320, 320), (1280, 1280)]
         faces = []
         
-        # Lower threshold to find tricky faces
-        self.app.det_model.det_thresh = 0.3
-        
-        for size in det_sizes:
-            try:
-                self.app.prepare(ctx_id=0, det_size=size)
-                faces = self.app.get(img)
-                if faces:
-                    break
-            except Exception as e:
-                pass
-        
+        with self._detect_lock:
+            # Lower threshold to find tricky faces
+            self.app.det_model.det_thresh = 0.3
+            
+            for size in det_sizes:
+                try:
+                    self.app.prepare(ctx_id=0, det_size=size)
+                    faces = self.app.get(img)
+                    if faces:
+                        break
+                except Exception as e:
+                    pass
+        return faces
+
+    def swap_detected_faces(self, img, faces, enhance=False, upscale=1):
         if not faces:
             return img # Return original if no faces found
 
+        # Reload anything the residency manager unloaded since the job started
+        swapper = self.swapper or self.ensure_swapper()
+        enhancer = None
+        if enhance:
+            enhancer = self.enhancer
+            if enhancer is None and os.path.exists(os.path.join(CHECKPOINTS_DIR, 'GFPGANv1.4.pth')):
+                enhancer = self.initialize_enhancer(upscale=upscale)
+
         # Prepare source face object (mock)
         class SourceFace:
             def __init__(self, embedding):
@@ -336,22 +980,110 @@ class FaceTrainer:
         # Swap ALL faces in target
         res_img = img.copy()
         for face in faces:
-            res_img = self.swapper.get(res_img, face, source_face, paste_back=True)
+            res_img = swapper.get(res_img, face, source_face, paste_back=True)
             
         # Enhance Result if requested
-        if enhance and self.enhancer:
+        if enhance and enhancer:
             try:
-                weight = 1.0 if self.enhancer.upscale > 1 else 0.5
-                _, _, res_img = self.enhancer.enhance(res_img, has_aligned=False, only_center_face=False, paste_back=True, weight=weight)
+                weight = 1.0 if enhancer.upscale > 1 else 0.5
+                with self._enhance_lock:
+                    _, _, res_img = enhancer.enhance(res_img, has_aligned=False, only_center_face=False, paste_back=True, weight=weight)
                 
-                if self.enhancer.upscale > 1:
+                if enhancer.upscale > 1:
                     res_img = self.sharpen_image(res_img)
             except Exception as e:
                 print(f"Warning: Enhancement failed: {e}", file=sys.stderr)
             
         return res_img
 
-    def batch_swap(self, model_path, input_dir, output_dir, enhance=False, upscale=1):
+    def process_frame(self, img, enhance=False, upscale=1):
+        """
+        Process a single image frame (numpy array) and return the result.
+        Assumes models are loaded.
+        """
+        # Ensure imports are available for process_frame if called directly or via ensure_swapper
+        if not self.app:
+            self.initialize()
+
+        faces = self.detect_target_faces(img)
+        return self.swap_detected_faces(img, faces, enhance, upscale)
+
+    def process_frames(self, imgs, enhance=False, upscale=1):
+        """
+        Batched process_frame: one detector pass over all images at 640x640.
+        Images where nothing is found fall back to the remaining adaptive sizes one by one.
+        """
+        if not self.app:
+            self.initialize()
+
+        try:
+            # The swapper only needs landmarks from the target faces, so recognition is skipped
+            faces_per_image = self.get_faces_batch(imgs, det_size=(640, 640), with_embedding=False)
+        except Exception as e:
+            print(f"Warning: batched detection failed, falling back to per-image: {e}", file=sys.stderr)
+            faces_per_image = [None] * len(imgs)
+
+        results = []
+        for img, faces in zip(imgs, faces_per_image):
+            if faces is None:
+                faces = self.detect_target_faces(img)
+            elif not faces:
+                faces = self.detect_target_faces(img, det_sizes=((320, 320), (1280, 1280)))
+            results.append(self.swap_detected_faces(img, faces, enhance, upscale))
+        return results
+
+    def read_image(self, input_path):
+        img = cv2.imread(input_path)
+        if img is None:
+            return None
+
+        # Fix EXIF orientation
+        try:
+            from PIL import Image, ImageOps
+            pil_img = Image.open(input_path)
+            pil_img = ImageOps.exif_transpose(pil_img)
+            img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
+        except Exception:
+            pass
+        return img
+
+    def swap_batch_to_dir(self, input_dir, filenames, output_dir, enhance=False, upscale=1):
+        """
+        Swap one micro-batch of files from input_dir into output_dir as swap_<name>.
+        Yields (filename, output_path) per file, with output_path None if it failed.
+        """
+        batch = []
+        for filename in filenames:
+            try:
+                img = self.read_image(os.path.join(input_dir, filename))
+                if img is not None:
+                    batch.append((filename, img))
+                else:
+                    yield filename, None
+            except Exception as e:
+                print(f"Error processing {filename}: {e}", file=sys.stderr)
+                yield filename, None
+        if not batch:
+            return
+
+        try:
+            res_imgs = self.process_frames([img for _, img in batch], enhance, upscale)
+        except Exception as e:
+            print(f"Warning: batch processing failed, retrying images one by one: {e}", file=sys.stderr)
+            res_imgs = [None] * len(batch)
+
+        for (filename, img), res_img in zip(batch, res_imgs):
+            output_path = os.path.join(output_dir, f"swap_{filename}")
+            try:
+                if res_img is None:
+                    res_img = self.process_frame(img, enhance, upscale)
+                cv2.imwrite(output_path, res_img)
+                yield filename, output_path
+            except Exception as e:
+                print(f"Error processing {filename}: {e}", file=sys.stderr)
+                yield filename, None
+
+    def batch_swap(self, model_path, input_dir, output_dir, enhance=False, upscale=1, batch_size=DEFAULT_BATCH_SIZE):
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
 
@@ -366,8 +1098,9 @@ class FaceTrainer:
         except Exception as e:
              print(json.dumps({"error": f"Failed to load model: {str(e)}"}), file=sys.stdout)
              return
+        print(f"Resident models: {json.dumps(self.models.report())}", file=sys.stderr)
 
-        image_files = [f for f in os.listdir(input_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))]
+        image_files = [f for f in os.listdir(input_dir) if f.lower().endswith(SWAP_IMAGE_EXTENSIONS)]
         total_images = len(image_files)
         
         if total_images == 0:
@@ -377,31 +1110,12 @@ class FaceTrainer:
         print(f"Found {total_images} images. Starting batch processing...", file=sys.stderr)
         
         processed_count = 0
-        import time
         start_time = time.time()
 
-        for idx, filename in enumerate(image_files):
-            input_path = os.path.join(input_dir, filename)
-            output_path = os.path.join(output_dir, f"swap_{filename}")
-            
-            try:
-                img = cv2.imread(input_path)
-                if img is None:
+        for batch_files in chunked(image_files, batch_size):
+            for filename, output_path in self.swap_batch_to_dir(input_dir, batch_files, output_dir, enhance, upscale):
+                if output_path is None:
                     continue
-
-                # Fix EXIF orientation
-                try:
-                    from PIL import Image, ImageOps
-                    pil_img = Image.open(input_path)
-                    pil_img = ImageOps.exif_transpose(pil_img)
-                    img = cv2.cvtColor(np.array(pil_img), cv2.COLOR_RGB2BGR)
-                except Exception:
-                    pass
-
-                res_img = self.process_frame(img, enhance, upscale)
-                
-                cv2.imwrite(output_path, res_img)
-                
                 processed_count += 1
                 
                 # Calculate progress
@@ -420,11 +1134,373 @@ class FaceTrainer:
                 print(json.dumps(progress_data), file=sys.stdout)
                 sys.stdout.flush()
 
-            except Exception as e:
-                print(f"Error processing {filename}: {e}", file=sys.stderr)
-
         print(json.dumps({"success": True, "count": processed_count, "output_dir": output_dir}), file=sys.stdout)
 
+    def watch_swap(self, model_path, input_dir, output_dir, enhance=False, upscale=1, batch_size=DEFAULT_BATCH_SIZE,
+                   concurrency=DEFAULT_WATCH_CONCURRENCY, queue_size=DEFAULT_WATCH_QUEUE_SIZE, poll_interval=DEFAULT_WATCH_POLL_INTERVAL):
+        """
+        Hot-folder mode: keep the models warm and swap every new image that lands in input_dir
+        until SIGINT/SIGTERM. Handled files are recorded in output_dir so a restart skips them.
+        """
+        if not os.path.isdir(input_dir):
+             print(json.dumps({"error": "Input directory does not exist"}), file=sys.stdout)
+             return
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+
+        print(f"Loading model from {model_path}...", file=sys.stderr)
+        try:
+            self.load_model(model_path)
+            self.ensure_swapper()
+            if not self.app:
+                self.initialize()
+            if enhance:
+                self.initialize_enhancer(upscale=upscale)
+        except Exception as e:
+             print(json.dumps({"error": f"Failed to load model: {str(e)}"}), file=sys.stdout)
+             return
+        print(f"Resident models: {json.dumps(self.models.report())}", file=sys.stderr)
+
+        ledger = ProcessedLedger(os.path.join(output_dir, '.watch_processed.jsonl'))
+        work = queue.Queue(maxsize=max(1, queue_size))
+        stop = threading.Event()
+        state_lock = threading.Lock()
+        # Files queued or being processed, so repeated events/scans don't enqueue them twice
+        in_flight = set()
+        processed_count = 0
+        failed_count = 0
+        # Progress is reported against the current backlog (reset whenever the watcher drains),
+        # and the ETA uses time actually spent swapping rather than wall-clock time since start
+        backlog_done = 0
+        busy_seconds = 0.0
+        busy_files = 0
+        same_dir = os.path.abspath(input_dir) == os.path.abspath(output_dir)
+
+        def on_signal(signum, frame):
+            stop.set()
+        signal.signal(signal.SIGINT, on_signal)
+        signal.signal(signal.SIGTERM, on_signal)
+
+        def file_key(filename):
+            try:
+                st = os.stat(os.path.join(input_dir, filename))
+            except OSError:
+                return None
+            return (filename, st.st_size, int(st.st_mtime))
+
+        def is_candidate(filename):
+            if filename.startswith('.') or not filename.lower().endswith(SWAP_IMAGE_EXTENSIONS):
+                return False
+            # Don't feed our own results back in when writing next to the inputs
+            return not (same_dir and filename.startswith('swap_'))
+
+        def worker():
+            nonlocal processed_count, failed_count, backlog_done, busy_seconds, busy_files
+            while not stop.is_set():
+                try:
+                    items = [work.get(timeout=0.5)]
+                except queue.Empty:
+                    continue
+                # Whatever else is already waiting joins the same micro-batch
+                while len(items) < batch_size:
+                    try:
+                        items.append(work.get_nowait())
+                    except queue.Empty:
+                        break
+
+                # A file rewritten while still queued shows up under several keys; only its newest
+                # version is on disk, so that one is swapped and the superseded keys are released
+                keys = {}
+                for key in items:
+                    current = keys.get(key[0])
+                    if current is None or (key[2], key[1]) > (current[2], current[1]):
+                        keys[key[0]] = key
+                pending = dict(keys)
+
+                batch_start = time.time()
+                batch_files = 0
+                try:
+                    for filename, output_path in self.swap_batch_to_dir(input_dir, list(keys), output_dir, enhance, upscale):
+                        key = pending[filename]
+                        batch_files += 1
+                        ledger.record(key, "ok" if output_path else "error", output_path)
+                        del pending[filename]
+                        with state_lock:
+                            in_flight.discard(key)
+                            backlog_done += 1
+                            if output_path is None:
+                                failed_count += 1
+                                continue
+                            processed_count += 1
+                            total = backlog_done + len(in_flight)
+                            per_file = (busy_seconds + time.time() - batch_start) / max(1, busy_files + batch_files)
+                            eta = len(in_flight) * per_file / max(1, concurrency)
+
+                            progress_data = {
+                                "progress": int((backlog_done / total) * 100),
+                                "current": backlog_done,
+                                "total": total,
+                                "eta_seconds": int(eta),
+                                "filename": filename
+                            }
+                            print(json.dumps(progress_data), file=sys.stdout)
+                            sys.stdout.flush()
+                except Exception as e:
+                    # Anything swap_batch_to_dir didn't handle (ledger write, closed stdout, ...) must not
+                    # kill the worker: the rest of the batch is recorded as failed and the loop goes on
+                    print(f"Error in watch worker: {e}", file=sys.stderr)
+                    for key in pending.values():
+                        try:
+                            ledger.record(key, "error")
+                        except OSError:
+                            pass
+                    with state_lock:
+                        failed_count += len(pending)
+                        backlog_done += len(pending)
+                finally:
+                    with state_lock:
+                        busy_seconds += time.time() - batch_start
+                        busy_files += batch_files
+                        for key in items:
+                            in_flight.discard(key)
+                    for _ in items:
+                        work.task_done()
+
+        def enqueue(key):
+            nonlocal backlog_done
+            with state_lock:
+                if key in in_flight or key in ledger:
+                    return
+                if not in_flight:
+                    backlog_done = 0
+                in_flight.add(key)
+            # Blocks while the queue is full, which throttles scanning instead of buffering the whole folder
+            while not stop.is_set():
+                try:
+                    work.put(key, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, concurrency))]
+        for t in workers:
+            t.start()
+
+        try:
+            watcher = InotifyWatcher(input_dir)
+            print(f"Watching {input_dir} with inotify", file=sys.stderr)
+        except OSError as e:
+            watcher = None
+            print(f"inotify unavailable ({e}), polling {input_dir} every {poll_interval}s", file=sys.stderr)
+
+        # Files found by scanning are only taken once their size/mtime have been stable for a poll interval;
+        # inotify close-write/moved-to events already mean the writer is done
+        unsettled = {}
+
+        def scan():
+            for filename in os.listdir(input_dir):
+                if is_candidate(filename) and filename not in unsettled:
+                    key = file_key(filename)
+                    with state_lock:
+                        known = key is None or key in ledger or key in in_flight
+                    if not known:
+                        unsettled[filename] = (None, time.time())
+
+        try:
+            scan()
+            last_scan = time.time()
+            while not stop.is_set():
+                if watcher:
+                    names, overflowed = watcher.read(timeout=poll_interval)
+                    for filename in names:
+                        if is_candidate(filename):
+                            key = file_key(filename)
+                            unsettled.pop(filename, None)
+                            if key and key[1] > 0:
+                                enqueue(key)
+                    # Events can be lost (queue overflow, files changed while we were blocked), so rescan now and then
+                    if overflowed or time.time() - last_scan >= DEFAULT_WATCH_RESCAN_INTERVAL:
+                        scan()
+                        last_scan = time.time()
+                else:
+                    stop.wait(poll_interval)
+                    scan()
+
+                now = time.time()
+                for filename, (last_key, since) in list(unsettled.items()):
+                    key = file_key(filename)
+                    if key is None:
+                        del unsettled[filename]
+                    elif key != last_key:
+                        unsettled[filename] = (key, now)
+                    elif key[1] > 0 and now - since >= poll_interval:
+                        del unsettled[filename]
+                        enqueue(key)
+        finally:
+            stop.set()
+            if watcher:
+                watcher.close()
+            for t in workers:
+                t.join()
+
+        print(json.dumps({"success": True, "count": processed_count, "failed": failed_count, "output_dir": output_dir}), file=sys.stdout)
+
+    def stream_swap(self, model_path, source, output, enhance=False, target_fps=None, latency_budget_ms=None,
+                    stream_format=DEFAULT_STREAM_FORMAT, report_interval=DEFAULT_STREAM_REPORT_INTERVAL):
+        """
+        Live mode: swap frames from any ffmpeg-readable source (file, URL, FIFO, '-' for stdin)
+        into an encoded stream on output (file, FIFO, '-' for stdout), staying within a latency budget
+        by dropping frames and stepping down STREAM_QUALITY_LEVELS. To try it at real-time speed:
+            ffmpeg -re -i clip.mp4 -f mpegts - | python face_swap_trainer.py --command stream_swap \
+                --model_path model.fsem --dataset_path - --output_path out.ts
+        """
+        # Reports are JSON lines on stdout, unless stdout carries the video itself
+        report_file = sys.stderr if is_stdio_target(output) else sys.stdout
+
+        print(f"Loading model from {model_path}...", file=sys.stderr)
+        try:
+            self.load_model(model_path)
+            self.ensure_swapper()
+            if not self.app:
+                self.initialize()
+            if enhance:
+                # Output keeps the input resolution, so the enhancer never upscales in stream mode
+                self.initialize_enhancer(upscale=1)
+        except Exception as e:
+             print(json.dumps({"error": f"Failed to load model: {str(e)}"}), file=report_file)
+             return
+
+        try:
+            reader = FFmpegFrameReader(source)
+        except Exception as e:
+            print(json.dumps({"error": f"Failed to open stream: {str(e)}"}), file=report_file)
+            return
+
+        width, height, fps = reader.width, reader.height, reader.fps
+        min_interval = 1.0 / target_fps if target_fps else 0.0
+        budget = latency_budget_ms / 1000.0 if latency_budget_ms else 1.0 / (target_fps or fps)
+        print(f"Streaming {width}x{height} @ {fps:g} fps, latency budget {budget * 1000:.0f} ms", file=sys.stderr)
+
+        # The encoder always gets one frame per input frame (dropped ones repeat the last result) so timing stays intact
+        out_target = 'pipe:1' if is_stdio_target(output) else output
+        enc_cmd = [get_ffmpeg_exe(), '-hide_banner', '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', f'{fps:g}', '-i', 'pipe:0', '-an']
+        if stream_format == 'rawvideo':
+            enc_cmd += ['-f', 'rawvideo', '-pix_fmt', 'bgr24', out_target]
+        else:
+            enc_cmd += ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-pix_fmt', 'yuv420p', '-f', stream_format, out_target]
+        encoder = subprocess.Popen(enc_cmd, stdin=subprocess.PIPE)
+
+        min_level = 0 if enhance else 1
+        level = min_level
+        latencies = deque(maxlen=300)
+        recent = deque(maxlen=15)
+        last_level_change = time.time()
+        last_processed_arrival = None
+        last_output = None
+        next_seq = 0
+        processed = 0
+        dropped = 0
+        start_time = time.time()
+        last_report = start_time
+
+        stop = threading.Event()
+
+        def on_signal(signum, frame):
+            stop.set()
+        signal.signal(signal.SIGINT, on_signal)
+        signal.signal(signal.SIGTERM, on_signal)
+
+        def stats():
+            elapsed = max(time.time() - start_time, 1e-6)
+            pct = np.percentile(latencies, [50, 90, 99]) if latencies else [0, 0, 0]
+            return {
+                "frames_in": reader.received,
+                "processed": processed,
+                "dropped": dropped,
+                "fps": round(processed / elapsed, 2),
+                "latency_ms": {"p50": round(pct[0] * 1000, 1), "p90": round(pct[1] * 1000, 1), "p99": round(pct[2] * 1000, 1)},
+                "quality": STREAM_QUALITY_LEVELS[level]["name"]
+            }
+
+        def write(img):
+            encoder.stdin.write(img.tobytes())
+
+        try:
+            while not stop.is_set():
+                frames = reader.take_all(timeout=0.5)
+                if frames is None:
+                    break
+                if not frames:
+                    continue
+
+                # Frames that overflowed the reader's buffer never reached us, but still take their slot in the output
+                missed = frames[0][0] - next_seq
+                dropped += missed
+                for _ in range(missed):
+                    write(last_output if last_output is not None else frames[0][2])
+                next_seq = frames[-1][0] + 1
+
+                # Only the newest frame is worth processing; anything older we could not keep up with
+                *stale, (_, arrived, frame) = frames
+                for _, _, old in stale:
+                    dropped += 1
+                    write(last_output if last_output is not None else old)
+
+                too_soon = last_processed_arrival is not None and arrived - last_processed_arrival < min_interval
+                if too_soon or time.time() - arrived > budget:
+                    dropped += 1
+                    write(last_output if last_output is not None else frame)
+                    continue
+
+                settings = STREAM_QUALITY_LEVELS[level]
+                try:
+                    faces = self.get_faces_batch([frame], det_size=settings["det_size"], with_embedding=False)[0]
+                    result = self.swap_detected_faces(frame, faces, enhance and settings["enhance"], 1)
+                    if result.shape != frame.shape:
+                        result = cv2.resize(result, (width, height))
+                except Exception as e:
+                    print(f"Warning: stream frame failed: {e}", file=sys.stderr)
+                    result = frame
+
+                write(result)
+                last_output = result
+                last_processed_arrival = arrived
+                processed += 1
+                now = time.time()
+                latencies.append(now - arrived)
+                recent.append(now - arrived)
+
+                # Step quality down quickly when over budget, back up slowly when well under it
+                if len(recent) >= 5:
+                    p90 = np.percentile(recent, 90)
+                    if p90 > budget and level < len(STREAM_QUALITY_LEVELS) - 1 and now - last_level_change > 1.0:
+                        level += 1
+                    elif p90 < budget * 0.5 and level > min_level and now - last_level_change > 3.0:
+                        level -= 1
+                    if STREAM_QUALITY_LEVELS[level] is not settings:
+                        last_level_change = now
+                        recent.clear()
+                        print(f"Stream quality -> {STREAM_QUALITY_LEVELS[level]['name']} (p90 {p90 * 1000:.0f} ms)", file=sys.stderr)
+
+                if now - last_report >= report_interval:
+                    print(json.dumps({"stream": True, **stats()}), file=report_file)
+                    report_file.flush()
+                    last_report = now
+            if stop.is_set():
+                print("Stopping stream", file=sys.stderr)
+        except BrokenPipeError:
+            print("Output closed, stopping stream", file=sys.stderr)
+        finally:
+            reader.close()
+            try:
+                encoder.stdin.close()
+            except BrokenPipeError:
+                pass
+            encoder.wait()
+
+        print(json.dumps({"success": True, "output_path": output, **stats()}), file=report_file)
+
     def swap_face(self, model_path, target_image_path, output_path, enhance=False, upscale=1, skip_loading=False):
         try:
             if not skip_loading and model_path:
@@ -463,7 +1539,7 @@ class FaceTrainer:
         except Exception as e:
             return {"success": False, "error": str(e)}
 
-    def process_video(self, model_path, input_video_path, output_video_path, enhance=False, upscale=1):
+    def process_video(self, model_path, input_video_path, output_video_path, enhance=False, upscale=1, batch_size=DEFAULT_BATCH_SIZE, max_batch_latency_ms=DEFAULT_MAX_BATCH_LATENCY_MS):
         try:
             # Try new moviepy 2.0 import
             from moviepy import VideoFileClip
@@ -486,61 +1562,52 @@ class FaceTrainer:
         except Exception as e:
              print(json.dumps({"error": f"Failed to load model: {str(e)}"}), file=sys.stdout)
              return
+        print(f"Resident models: {json.dumps(self.models.report())}", file=sys.stderr)
 
         try:
             clip = VideoFileClip(input_video_path)
             total_frames = int(clip.duration * clip.fps)
             
             processed_frames = 0
-            import time
             start_time = time.time()
 
-            def process_frame_wrapper(get_frame, t):
-                nonlocal processed_frames, start_time
-                frame = get_frame(t) # RGB numpy array
-                
-                # Convert RGB to BGR for cv2 processing
-                frame_bgr = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-                
-                # Process
-                res_bgr = self.process_frame(frame_bgr, enhance, upscale)
-                
-                # Convert back to RGB
-                res_rgb = cv2.cvtColor(res_bgr, cv2.COLOR_BGR2RGB)
-                
-                processed_frames += 1
-                if processed_frames % 10 == 0: # Update every 10 frames to reduce spam
-                    elapsed = time.time() - start_time
-                    avg_time = elapsed / processed_frames
-                    remaining = total_frames - processed_frames
-                    eta = remaining * avg_time
-                    
-                    progress_data = {
-                        "progress": int((processed_frames / total_frames) * 100),
-                        "current": processed_frames,
-                        "total": total_frames,
-                        "eta_seconds": int(eta),
-                        "filename": os.path.basename(input_video_path)
-                    }
-                    print(json.dumps(progress_data), file=sys.stdout)
-                    sys.stdout.flush()
-                
-                return res_rgb
+            fps = clip.fps
+            max_latency = max_batch_latency_ms / 1000.0
+            frame_cache = {}
+            # Indices already swapped, so a frame recomputed after a cache miss isn't counted twice
+            swapped_indices = set()
 
-            # Use image_transform (moviepy 2.0) or fl_image (moviepy 1.x) to process each frame
-            # Note: moviepy passes the frame image directly
-            def frame_processor(image):
+            # moviepy asks for frames in order through get_frame(t) (plus once at t=0 when the clip is built);
+            # on a miss we read ahead up to batch_size frames (stopping early if decoding exceeds the latency cap)
+            # and swap them in one batch. Results stay cached until playback moves past them.
+            def batched_frame_processor(get_frame, t):
                 nonlocal processed_frames, start_time
-                # Image is RGB
-                frame_bgr = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
-                res_bgr = self.process_frame(frame_bgr, enhance, upscale)
-                res_rgb = cv2.cvtColor(res_bgr, cv2.COLOR_BGR2RGB)
-                
-                processed_frames += 1
-                if processed_frames % 5 == 0:
+                index = int(round(t * fps))
+                for old in [i for i in frame_cache if i < index]:
+                    del frame_cache[old]
+                if index not in frame_cache:
+                    batch_indices = []
+                    frames = []
+                    deadline = time.time() + max_latency
+                    for k in range(batch_size):
+                        i = index + k
+                        if k > 0 and (i / fps >= clip.duration or time.time() > deadline):
+                            break
+                        # Image is RGB
+                        frame = get_frame(t if k == 0 else i / fps)
+                        frames.append(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+                        batch_indices.append(i)
+
+                    res_frames = self.process_frames(frames, enhance, upscale)
+                    for i, res_bgr in zip(batch_indices, res_frames):
+                        frame_cache[i] = cv2.cvtColor(res_bgr, cv2.COLOR_BGR2RGB)
+
+                    new_indices = [i for i in batch_indices if i not in swapped_indices]
+                    swapped_indices.update(new_indices)
+                    processed_frames += len(new_indices)
                     elapsed = time.time() - start_time
                     avg_time = elapsed / processed_frames
-                    remaining = total_frames - processed_frames
+                    remaining = max(0, total_frames - processed_frames)
                     eta = remaining * avg_time
                     
                     progress_data = {
@@ -552,14 +1619,16 @@ class FaceTrainer:
                     }
                     print(json.dumps(progress_data), file=sys.stdout)
                     sys.stdout.flush()
-                return res_rgb
+                
+                return frame_cache[index]
 
-            if hasattr(clip, 'fl_image'):
-                new_clip = clip.fl_image(frame_processor)
-            elif hasattr(clip, 'image_transform'):
-                 new_clip = clip.image_transform(frame_processor)
+            # Use transform (moviepy 2.0) or fl (moviepy 1.x) so the processor sees frame times
+            if hasattr(clip, 'fl'):
+                new_clip = clip.fl(batched_frame_processor)
+            elif hasattr(clip, 'transform'):
+                 new_clip = clip.transform(batched_frame_processor)
             else:
-                 raise AttributeError("VideoClip object has neither 'fl_image' nor 'image_transform'")
+                 raise AttributeError("VideoClip object has neither 'fl' nor 'transform'")
             
             # Write video file
 
@@ -584,10 +1653,25 @@ def main():
     parser.add_argument("--target_image")
     parser.add_argument("--enhance", action="store_true", help="Enable face enhancement")
     parser.add_argument("--upscale", type=int, default=1, help="Upscale factor for enhancement")
+    parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH_SIZE, help="Images/frames per detection and recognition call")
+    parser.add_argument("--max_batch_latency_ms", type=float, default=DEFAULT_MAX_BATCH_LATENCY_MS, help="Max time a video batch waits to fill before it is processed")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_WATCH_CONCURRENCY, help="Worker threads for watch mode")
+    parser.add_argument("--queue_size", type=int, default=DEFAULT_WATCH_QUEUE_SIZE, help="Max files waiting to be processed in watch mode")
+    parser.add_argument("--poll_interval", type=float, default=DEFAULT_WATCH_POLL_INTERVAL, help="Seconds between directory checks in watch mode")
+    parser.add_argument("--target_fps", type=float, help="Max frames per second to swap in stream mode")
+    parser.add_argument("--latency_budget_ms", type=float, help="Per-frame latency budget in stream mode (default: one frame interval)")
+    parser.add_argument("--stream_format", default=DEFAULT_STREAM_FORMAT, help="ffmpeg output format for stream mode (mpegts, rawvideo, ...)")
+    parser.add_argument("--report_interval", type=float, default=DEFAULT_STREAM_REPORT_INTERVAL, help="Seconds between latency reports in stream mode")
+    parser.add_argument("--no_prefilter", action="store_true", help="Embed every training image without the quality/duplicate pre-pass")
+    parser.add_argument("--min_image_size", type=int, default=DEFAULT_MIN_IMAGE_SIZE, help="Skip training images whose shorter side is smaller")
+    parser.add_argument("--blur_threshold", type=float, default=DEFAULT_BLUR_THRESHOLD, help="Skip training images with a lower Laplacian variance")
+    parser.add_argument("--dedup_distance", type=int, default=DEFAULT_DEDUP_DISTANCE, help="Max perceptual-hash distance for near-duplicate training images")
+    parser.add_argument("--model_memory_mb", type=float, default=DEFAULT_MODEL_MEMORY_MB, help="Soft memory budget for resident models (0 = unlimited)")
+    parser.add_argument("--model_idle_seconds", type=float, default=DEFAULT_MODEL_IDLE_SECONDS, help="Also unload models unused for this long (default 0 = only unload under memory pressure)")
     
     args = parser.parse_args()
     
-    trainer = FaceTrainer()
+    trainer = FaceTrainer(model_memory_mb=args.model_memory_mb, model_idle_seconds=args.model_idle_seconds)
     
     try:
         if args.command == "detect_faces":
@@ -595,7 +1679,8 @@ def main():
             print(json.dumps(res))
             
         elif args.command == "train":
-            res = trainer.train_model(args.dataset_path, args.output_path, args.model_name)
+            res = trainer.train_model(args.dataset_path, args.output_path, args.model_name, batch_size=args.batch_size, prefilter=not args.no_prefilter,
+                                      min_size=args.min_image_size, blur_threshold=args.blur_threshold, dedup_distance=args.dedup_distance)
             print(json.dumps(res))
             
         elif args.command == "swap":
@@ -603,11 +1688,21 @@ def main():
             print(json.dumps(res))
 
         elif args.command == "batch_swap":
-            trainer.batch_swap(args.model_path, args.dataset_path, args.output_path, enhance=args.enhance, upscale=args.upscale)
+            trainer.batch_swap(args.model_path, args.dataset_path, args.output_path, enhance=args.enhance, upscale=args.upscale, batch_size=args.batch_size)
+
+        elif args.command == "watch":
+            # For watch, dataset_path is the hot folder and output_path the results directory
+            trainer.watch_swap(args.model_path, args.dataset_path, args.output_path, enhance=args.enhance, upscale=args.upscale, batch_size=args.batch_size,
+                               concurrency=args.concurrency, queue_size=args.queue_size, poll_interval=args.poll_interval)
+
+        elif args.command == "stream_swap":
+            # For stream swap, dataset_path is the source and output_path the destination ('-' for stdin/stdout)
+            trainer.stream_swap(args.model_path, args.dataset_path, args.output_path, enhance=args.enhance, target_fps=args.target_fps,
+                                latency_budget_ms=args.latency_budget_ms, stream_format=args.stream_format, report_interval=args.report_interval)
 
         elif args.command == "video_swap":
             # For video swap, dataset_path argument is used as input video path
-            trainer.process_video(args.model_path, args.dataset_path, args.output_path, enhance=args.enhance, upscale=args.upscale)
+            trainer.process_video(args.model_path, args.dataset_path, args.output_path, enhance=args.enhance, upscale=args.upscale, batch_size=args.batch_size, max_batch_latency_ms=args.max_batch_latency_ms)
             
         else:
             print(json.dumps({"error": "Unknown command"}))